@@ -1,11 +1,14 @@
 """MongoDB Atlas helpers for the RAG learning project."""
+import asyncio
+import hashlib
 import os
 from datetime import datetime, timezone
 from typing import Any
 
 from bson import ObjectId
-from pymongo import MongoClient
-from pymongo.collection import Collection
+from bson.binary import VECTOR_SUBTYPE, Binary, BinaryVectorDtype
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
 from dotenv import load_dotenv
 
 
@@ -15,44 +18,203 @@ MONGODB_URI = os.getenv("MONGODB_URI", "")
 MONGODB_DB = os.getenv("MONGODB_DB", "rag_learning")
 MONGODB_COLLECTION = os.getenv("MONGODB_COLLECTION", "rag_documents")
 VECTOR_INDEX_NAME = os.getenv("VECTOR_INDEX_NAME", "rag_vector_index")
+CHAT_CACHE_COLLECTION = os.getenv("CHAT_CACHE_COLLECTION", "chat_cache")
+CHAT_CACHE_INDEX_NAME = os.getenv("CHAT_CACHE_INDEX_NAME", "chat_cache_vector_index")
+CHAT_CACHE_TTL_SECONDS = int(os.getenv("CHAT_CACHE_TTL_SECONDS", "86400"))
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
 
-_client: MongoClient | None = None
+_client: AsyncIOMotorClient | None = None
 
 
-def get_collection() -> Collection:
+def connect_mongo() -> AsyncIOMotorClient:
     """
-    Create (or reuse) a MongoDB client.
+    Create (or reuse) an async MongoDB client (Motor) with a tuned connection pool.
     The URI is read from environment variables to keep secrets out of code.
+    Called from the app startup hook so the pool is ready before the first request.
     """
     if not MONGODB_URI:
         raise RuntimeError("MONGODB_URI is not set")
 
     global _client
     if _client is None:
-        _client = MongoClient(MONGODB_URI)
+        _client = AsyncIOMotorClient(
+            MONGODB_URI,
+            maxPoolSize=200,
+            minPoolSize=20,
+            maxIdleTimeMS=60000,
+            # Embedding-heavy documents compress well on the wire.
+            compressors="zstd",
+            retryWrites=True,
+            appname="rag-learning",
+        )
+
+    return _client
+
+
+def close_mongo() -> None:
+    """Close the MongoDB client and its pooled connections."""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+def get_collection() -> AsyncIOMotorCollection:
+    """Return the RAG collection from the shared MongoDB client."""
+    return connect_mongo()[MONGODB_DB][MONGODB_COLLECTION]
+
+
+def get_cache_collection() -> AsyncIOMotorCollection:
+    """
+    Return the semantic answer cache collection.
+    Cache entries live apart from the chat logs so they can expire
+    without touching the logs kept for study.
+    """
+    return get_collection().database[CHAT_CACHE_COLLECTION]
+
+
+def to_vector_binary(vector: list[float]) -> Binary:
+    """
+    Pack an embedding as a BSON binData float32 vector.
+    A BSON array of doubles costs 9 bytes per element (type tag + float64);
+    packed float32 costs 4, so documents are roughly half the size on disk
+    and on the wire. Atlas Vector Search indexes binData vectors natively.
+    """
+    return Binary.from_vector(vector, BinaryVectorDtype.FLOAT32)
+
+
+def to_int8_vector_binary(vector: list[float]) -> Binary:
+    """
+    Scalar-quantize an embedding to int8 and pack it as BSON binData.
+    Each vector is scaled so its largest component maps to 127; cosine
+    similarity ignores the scale, so stored and query vectors stay comparable
+    as long as both go through this function. 1 byte per dimension is 4x
+    smaller than float32, which shrinks the vector index and speeds up scoring.
+    """
+    peak = max((abs(x) for x in vector), default=0.0)
+    scale = 127 / peak if peak else 0.0
+    quantized = [max(-128, min(127, round(x * scale))) for x in vector]
+    return Binary.from_vector(quantized, BinaryVectorDtype.INT8)
+
 
-    return _client[MONGODB_DB][MONGODB_COLLECTION]
+def text_hash(text: str) -> str:
+    """SHA-256 of a chunk's text, stored as `text_hash` for duplicate lookups."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
 
-def store_rag_document(collection: Collection, document: dict[str, Any]) -> None:
-    """Insert a new RAG knowledge document into MongoDB."""
-    collection.insert_one(document)
+async def ensure_indexes(
+    collection: AsyncIOMotorCollection,
+    cache_collection: AsyncIOMotorCollection,
+) -> None:
+    """
+    Create the regular (non-search) indexes the app relies on.
+    create_index is a no-op when an identical index already exists.
+    """
+    # Lets list_rag_documents walk the index in sort order and stop after
+    # `limit` keys instead of scanning and sorting every RAG document in memory.
+    # chunk_index breaks ties between chunks stored in the same request, which
+    # share one created_at. A new name is used because create_index fails when
+    # an index with the same name but different keys already exists.
+    await collection.create_index(
+        [("type", 1), ("created_at", -1), ("chunk_index", -1)],
+        name="type_created_at_chunk_index",
+    )
+
+    # Lets find_stored_embeddings look chunks up by hash instead of scanning
+    # (and comparing the full text of) every RAG document.
+    await collection.create_index(
+        [("type", 1), ("text_hash", 1)],
+        name="type_text_hash",
+    )
+
+    # Expire cached answers so stale responses are not served forever.
+    await cache_collection.create_index(
+        [("created_at", 1)],
+        name="chat_cache_ttl",
+        expireAfterSeconds=CHAT_CACHE_TTL_SECONDS,
+    )
+
+
+async def store_rag_documents(
+    collection: AsyncIOMotorCollection,
+    documents: list[dict[str, Any]],
+) -> None:
+    """
+    Insert many RAG knowledge documents with a single bulk write.
+    ordered=False lets the server keep going past a failed document.
+    """
+    if documents:
+        await collection.insert_many(documents, ordered=False)
+
+
+async def find_stored_embeddings(
+    collection: AsyncIOMotorCollection,
+    texts: list[str],
+) -> dict[str, Binary]:
+    """
+    Look up chunks that were already embedded and stored earlier.
+    Returns text -> int8 embedding so callers can skip paying for them again.
+    The lookup goes through the {type, text_hash} index; older documents
+    without a hash or with other vector encodings are ignored (re-embedded).
+    """
+    if not texts:
+        return {}
+
+    texts_by_hash = {text_hash(text): text for text in texts}
+    cursor = collection.find(
+        {"type": "rag_document", "text_hash": {"$in": list(texts_by_hash)}},
+        {"_id": 0, "text_hash": 1, "embedding": 1},
+    )
+    found: dict[str, Binary] = {}
+    async for doc in cursor:
+        embedding = doc.get("embedding")
+        if (
+            isinstance(embedding, Binary)
+            and embedding.subtype == VECTOR_SUBTYPE
+            and embedding[:1] == BinaryVectorDtype.INT8.value
+        ):
+            found[texts_by_hash[doc["text_hash"]]] = embedding
+    return found
 
 
-def list_rag_documents(collection: Collection, limit: int = 50) -> list[dict[str, Any]]:
+async def get_corpus_version(collection: AsyncIOMotorCollection) -> str:
+    """
+    Return a cheap version tag for the stored RAG knowledge.
+    The newest document catches inserts and the document count catches deletes;
+    both are answered from the {type, created_at} index.
+    Used as the /rag/list ETag and to invalidate semantic cache entries.
+    """
+    newest, count = await asyncio.gather(
+        collection.find_one(
+            {"type": "rag_document"},
+            {"_id": 1, "created_at": 1},
+            sort=[("created_at", -1)],
+        ),
+        collection.count_documents({"type": "rag_document"}),
+    )
+    if newest:
+        raw = f"{newest['_id']}:{newest.get('created_at')}:{count}"
+    else:
+        raw = f"empty:{count}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+async def list_rag_documents(
+    collection: AsyncIOMotorCollection,
+    limit: int = 50,
+) -> list[dict[str, Any]]:
     """Return recent RAG knowledge documents for display in the UI."""
     cursor = (
         collection.find(
             {"type": "rag_document"},
             {"text": 1, "entity": 1, "slot": 1, "knowledge_type": 1, "created_at": 1},
         )
-        .sort("created_at", -1)
+        .sort([("created_at", -1), ("chunk_index", -1)])
         .limit(limit)
     )
     results = []
-    for doc in cursor:
+    async for doc in cursor:
         results.append(
             {
                 "id": str(doc.get("_id")),
@@ -66,32 +228,37 @@ def list_rag_documents(collection: Collection, limit: int = 50) -> list[dict[str
     return results
 
 
-def delete_rag_document(collection: Collection, document_id: str) -> bool:
+async def delete_rag_document(
+    collection: AsyncIOMotorCollection,
+    document_id: str,
+) -> bool:
     """Delete a single RAG knowledge document by its id."""
     try:
         object_id = ObjectId(document_id)
     except Exception:
         return False
 
-    result = collection.delete_one({"_id": object_id, "type": "rag_document"})
+    result = await collection.delete_one({"_id": object_id, "type": "rag_document"})
     return result.deleted_count > 0
 
-def build_rag_context(
-    collection: Collection,
+async def build_rag_context(
+    collection: AsyncIOMotorCollection,
     query_vector: list[float],
     limit: int = 3,
 ) -> list[dict[str, Any]]:
     """
     Use MongoDB Atlas Vector Search to retrieve similar documents.
     The vector index is assumed to exist already.
+    Stored embeddings are int8 binData, so the query is quantized the same way.
     """
     pipeline = [
         {
             "$vectorSearch": {
                 "index": VECTOR_INDEX_NAME,
                 "path": "embedding",
-                "queryVector": query_vector,
-                "numCandidates": 50,
+                "queryVector": to_int8_vector_binary(query_vector),
+                # Atlas guidance: ~10-20x candidates per result, with a floor for recall.
+                "numCandidates": max(50, limit * 10),
                 "limit": limit,
             }
         },
@@ -104,15 +271,97 @@ def build_rag_context(
         },
     ]
 
-    return list(collection.aggregate(pipeline))
+    # batchSize=limit returns every result in the first reply (no getMore round-trip).
+    cursor = collection.aggregate(pipeline, batchSize=limit)
+    return [{"text": doc["text"], "score": doc["score"]} async for doc in cursor]
+
+
+async def find_cached_answer(
+    cache_collection: AsyncIOMotorCollection,
+    question_vector: list[float],
+    endpoint: str,
+    corpus_version: str,
+    threshold: float | None = None,
+    min_score: float = 0.95,
+) -> dict[str, Any] | None:
+    """
+    Semantic cache lookup: return a previous answer whose question is
+    nearly identical to the current one, or None on a miss.
+    Entries only match when they were produced against the same knowledge
+    (corpus_version) and, for /chat/route, the same routing threshold.
+    Uses an Atlas Vector Search index on `question_embedding` with
+    `endpoint`, `corpus_version` and `threshold` declared as filter fields.
+    """
+    cache_filter: dict[str, Any] = {"endpoint": endpoint, "corpus_version": corpus_version}
+    if threshold is not None:
+        cache_filter["threshold"] = threshold
+
+    pipeline = [
+        {
+            "$vectorSearch": {
+                "index": CHAT_CACHE_INDEX_NAME,
+                "path": "question_embedding",
+                "queryVector": question_vector,
+                "numCandidates": 10,
+                "limit": 1,
+                "filter": cache_filter,
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "answer": 1,
+                "retrieved_documents": 1,
+                "route": 1,
+                "score": {"$meta": "vectorSearchScore"},
+            }
+        },
+    ]
+
+    try:
+        results = await cache_collection.aggregate(pipeline).to_list(length=1)
+    except PyMongoError:
+        # The cache is an optimization only; never fail a chat because of it.
+        return None
+
+    if results and results[0]["score"] >= min_score:
+        return results[0]
+    return None
+
+
+async def store_cached_answer(
+    cache_collection: AsyncIOMotorCollection,
+    question_vector: list[float],
+    endpoint: str,
+    corpus_version: str,
+    answer: str,
+    retrieved_documents: list[dict[str, Any]],
+    route: str | None = None,
+    threshold: float | None = None,
+) -> None:
+    """Store an answer in the semantic cache (expired by the TTL index)."""
+    entry = {
+        "endpoint": endpoint,
+        "corpus_version": corpus_version,
+        "question_embedding": to_vector_binary(question_vector),
+        "answer": answer,
+        "retrieved_documents": retrieved_documents,
+        "created_at": datetime.now(timezone.utc),
+    }
+    if route:
+        entry["route"] = route
+    if threshold is not None:
+        entry["threshold"] = threshold
+    await cache_collection.insert_one(entry)
 
 
-def log_chat(
-    collection: Collection,
+async def log_chat(
+    collection: AsyncIOMotorCollection,
     question: str,
     answer: str,
     retrieved_documents: list[dict[str, Any]],
     route: str | None = None,
+    cache_hit: bool = False,
 ) -> None:
     """Store a chat log with the RAG context used for the answer."""
     log_entry = {
@@ -124,4 +373,6 @@ def log_chat(
     }
     if route:
         log_entry["route"] = route
-    collection.insert_one(log_entry)
+    if cache_hit:
+        log_entry["cache_hit"] = True
+    await collection.insert_one(log_entry)
@@ -2,34 +2,99 @@
 FastAPI backend for a learning project that compares RAG vs plain LLM responses.
 We keep the code intentionally simple and heavily commented for study.
 """ 
+import asyncio
+import os
+from collections import OrderedDict
 from datetime import datetime, timezone
 from typing import Any
 
-from fastapi import FastAPI, HTTPException
+import tiktoken
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from openai import OpenAI
+from openai import AsyncOpenAI
 from pydantic import BaseModel, Field
 
 from db import (
     build_rag_context,
+    close_mongo,
+    connect_mongo,
     delete_rag_document,
+    ensure_indexes,
+    find_cached_answer,
+    find_stored_embeddings,
+    get_cache_collection,
     get_collection,
+    get_corpus_version,
     list_rag_documents,
     log_chat,
-    store_rag_document,
+    store_cached_answer,
+    store_rag_documents,
+    text_hash,
+    to_int8_vector_binary,
 )
 
 app = FastAPI(title="RAG vs LLM Learning API")
 
-# Allow local frontend to call the API during development.
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"]
-    ,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"]
+# One shared async client so the underlying HTTP connection pool (and its TLS
+# sessions) is reused across requests instead of rebuilt per call.
+openai_client = AsyncOpenAI()
+
+# Embedding API limit is 300k tokens per request; we keep a safety margin.
+# Large payloads are split into sub-batches that are sent concurrently,
+# with at most EMBEDDING_CONCURRENCY requests in flight at once.
+EMBEDDING_MAX_TOKENS_PER_REQUEST = 250_000
+EMBEDDING_BATCH_SIZE = 96
+EMBEDDING_CONCURRENCY = 4
+
+# Tokenizer used by text-embedding-3-small. Loaded on first use rather than at
+# import time: the first load downloads the BPE file (unless TIKTOKEN_CACHE_DIR
+# already holds it), and the API should still start without network access.
+_token_encoding: tiktoken.Encoding | None = None
+
+# Cosine similarity required to reuse a previous answer from the semantic cache.
+CHAT_CACHE_MIN_SCORE = 0.95
+
+# In-process LRU cache of question embeddings: (model, text) -> vector.
+QUERY_EMBEDDING_CACHE_SIZE = 2048
+_query_embedding_cache: OrderedDict[tuple[str, str], tuple[float, ...]] = OrderedDict()
+
+# Static prompt parts are built once; only the dynamic parts are formatted per call.
+SYSTEM_PROMPT = (
+    "You are a helpful assistant. Use the provided context when relevant, "
+    "and say when the context does not contain the answer."
 )
+ANSWER_SUFFIX = "\n\nAnswer in Korean to match the learning UI."
+
+# /chat/route skips retrieval only for these exact greetings / small talk messages
+# (compared after trimming whitespace and trailing punctuation, case-insensitive).
+SMALL_TALK_MESSAGES = frozenset({
+    "안녕", "안녕하세요", "하이", "ㅎㅇ", "반가워", "반갑습니다",
+    "고마워", "고맙습니다", "감사", "감사합니다", "ㄱㅅ", "잘가", "안녕히 계세요",
+    "hi", "hello", "hey", "thanks", "thank you", "bye",
+})
+
+# Allow the frontend to call the API with an explicit origin allowlist.
+# (A "*" origin combined with credentials is rejected by browsers anyway.)
+# In production CORS headers are set by the reverse proxy, so the middleware
+# is skipped entirely and adds no per-request work.
+APP_ENV = os.getenv("APP_ENV", "dev")
+CORS_ALLOW_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv(
+        "CORS_ALLOW_ORIGINS",
+        "http://localhost:3000,http://localhost:5500,http://127.0.0.1:5500",
+    ).split(",")
+    if origin.strip()
+]
+
+if APP_ENV != "prod":
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ALLOW_ORIGINS,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
 
 
 class RagStoreRequest(BaseModel):
@@ -76,83 +141,251 @@ class RagDocumentResponse(BaseModel):
 class RagListResponse(BaseModel):
     documents: list[RagDocumentResponse]
 
+def get_token_encoding() -> tiktoken.Encoding:
+    """Return the cl100k_base encoding, loading it on the first call."""
+    global _token_encoding
+    if _token_encoding is None:
+        _token_encoding = tiktoken.get_encoding("cl100k_base")
+    return _token_encoding
+
+
+def split_long_paragraph(
+    paragraph: str,
+    tokens: list[int],
+    max_tokens: int,
+) -> list[tuple[str, int]]:
+    """
+    Cut a paragraph that is longer than max_tokens into token windows.
+    Windows are sliced from the original text using the tokenizer's character
+    offsets, so multi-byte (Korean) characters are never broken in half.
+    A character split across two tokens goes to the later window, so a piece
+    can end up a token or two over max_tokens; pieces are re-encoded (only
+    these, which is rare) so the returned counts are exact.
+    Returns (text, token count) pairs.
+    """
+    encoding = get_token_encoding()
+    _, offsets = encoding.decode_with_offsets(tokens)
+    offsets.append(len(paragraph))
+
+    pieces: list[tuple[str, int]] = []
+    for start in range(0, len(tokens), max_tokens):
+        stop = min(start + max_tokens, len(tokens))
+        piece = paragraph[offsets[start]:offsets[stop]].strip()
+        if piece:
+            pieces.append((piece, len(encoding.encode(piece))))
+    return pieces
+
+
 def chunk_text(
     text: str,
-    max_chars: int = 1500,
-) -> list[str]:
+    max_tokens: int = 400,
+) -> list[tuple[str, int]]:
     """
     Simple chunking strategy:
     1) Split by double newlines (paragraph / section boundary)
-    2) Merge paragraphs until max_chars is reached
-    This is a character-based approximation of ~300–600 tokens for Korean text.
+    2) Merge paragraphs until max_tokens is reached
+    3) Cut paragraphs that alone exceed max_tokens into token windows
+    Tokens are counted with the embedding model's tokenizer (cl100k_base),
+    so chunk sizes match the model's real budget instead of a character guess.
+    Each paragraph is encoded once and the merged count is tracked
+    incrementally (the "\n\n" separator counts as one token), so merged
+    strings are never re-encoded.
+    Returns (chunk, token count) pairs so callers can reuse the counts.
     """
-    paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
-    chunks: list[str] = []
+    encoding = get_token_encoding()
+    chunks: list[tuple[str, int]] = []
+    buf: list[str] = []
+    buf_tokens = 0
+
+    i = 0
+    n = len(text)
+    while i <= n:
+        j = text.find("\n\n", i)
+        end = n if j == -1 else j
+        p = text[i:end].strip()
+        i = end + 2
+
+        if not p:
+            continue
+
+        p_token_ids = encoding.encode(p)
+        p_tokens = len(p_token_ids)
+
+        if p_tokens > max_tokens:
+            # Too long on its own: flush what we have, emit full windows,
+            # and keep the last window open so following paragraphs can join it.
+            if buf:
+                chunks.append(("\n\n".join(buf), buf_tokens))
+            pieces = split_long_paragraph(p, p_token_ids, max_tokens)
+            chunks.extend(pieces[:-1])
+            buf = [pieces[-1][0]]
+            buf_tokens = pieces[-1][1]
+            continue
 
-    current = ""
-    for p in paragraphs:
         # If adding this paragraph exceeds the limit, finalize current chunk
-        if len(current) + len(p) > max_chars:
-            if current:
-                chunks.append(current)
-            current = p
+        if buf and buf_tokens + 1 + p_tokens > max_tokens:
+            chunks.append(("\n\n".join(buf), buf_tokens))
+            buf = [p]
+            buf_tokens = p_tokens
         else:
-            current = p if not current else current + "\n\n" + p
+            buf_tokens += p_tokens + (1 if buf else 0)
+            buf.append(p)
 
-    if current:
-        chunks.append(current)
+    if buf:
+        chunks.append(("\n\n".join(buf), buf_tokens))
 
     return chunks
 
 
+def split_embedding_batches(chunks: list[str], token_counts: list[int]) -> list[list[str]]:
+    """
+    Group chunks so each embedding request stays under the API limits.
+    A batch is closed when it reaches EMBEDDING_BATCH_SIZE inputs or when
+    the next chunk would push it over the token budget.
+    Token counts come from chunk_text, so nothing is encoded twice.
+    """
+    batches: list[list[str]] = []
+    batch: list[str] = []
+    batch_tokens = 0
+    for chunk, tokens in zip(chunks, token_counts):
+        if batch and (
+            len(batch) >= EMBEDDING_BATCH_SIZE
+            or batch_tokens + tokens > EMBEDDING_MAX_TOKENS_PER_REQUEST
+        ):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += tokens
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def embed_chunks(chunks: list[str], token_counts: list[int]) -> list[list[float]]:
+    """
+    Embed many chunks with batched requests instead of one request per chunk.
+    Sub-batches run concurrently (bounded by a semaphore); asyncio.gather keeps
+    them in batch order, and each result's index maps back to its position
+    inside the batch, so the output lines up with `chunks`.
+    """
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+    async def embed_batch(batch: list[str]) -> list[list[float]]:
+        async with semaphore:
+            embedding_response = await openai_client.embeddings.create(
+                model="text-embedding-3-small",
+                input=batch,
+            )
+        batch_vectors: list[list[float]] = [[] for _ in batch]
+        for item in embedding_response.data:
+            batch_vectors[item.index] = item.embedding
+        return batch_vectors
+
+    results = await asyncio.gather(
+        *(embed_batch(batch) for batch in split_embedding_batches(chunks, token_counts))
+    )
+    return [vector for batch_vectors in results for vector in batch_vectors]
+
+
+async def embed_query(text: str, model: str = "text-embedding-3-small") -> tuple[float, ...]:
+    """
+    Embed a user question, caching the result in-process (LRU).
+    Repeated questions (common while testing the UI) skip the API call.
+    A tuple is returned so cached values cannot be mutated by callers.
+    functools.lru_cache cannot be used here because it would cache coroutines.
+    """
+    key = (model, text)
+    cached = _query_embedding_cache.get(key)
+    if cached is not None:
+        _query_embedding_cache.move_to_end(key)
+        return cached
+
+    embedding_response = await openai_client.embeddings.create(model=model, input=text)
+    vector = tuple(embedding_response.data[0].embedding)
+
+    _query_embedding_cache[key] = vector
+    if len(_query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+        _query_embedding_cache.popitem(last=False)
+    return vector
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    """Open the MongoDB pool and make sure indexes exist before serving requests."""
+    connect_mongo()
+    await ensure_indexes(get_collection(), get_cache_collection())
+
+
+@app.on_event("shutdown")
+def shutdown() -> None:
+    """Release pooled MongoDB connections."""
+    close_mongo()
+
+
 @app.get("/")
 def health() -> dict[str, str]:
     return {"status": "ok"}
 
 
 @app.post("/rag/store")
-def store_rag_knowledge(payload: RagStoreRequest) -> dict[str, str]:
+async def store_rag_knowledge(payload: RagStoreRequest) -> dict[str, str]:
     """
     Store user-provided knowledge for RAG with chunking.
     Steps:
       1) Split the text into semantic chunks.
-      2) Embed each chunk.
-      3) Store each chunk as a separate RAG document.
+      2) Embed all chunks with as few API requests as possible.
+         Duplicate chunks and chunks already stored earlier are not re-embedded.
+      3) Store each chunk as a separate RAG document (single bulk insert).
     """
-    client = OpenAI()
     collection = get_collection()
 
-    chunks = chunk_text(payload.text)
+    chunked = chunk_text(payload.text)
 
-    if not chunks:
+    if not chunked:
         raise HTTPException(status_code=400, detail="No valid text chunks to store.")
 
-    for idx, chunk in enumerate(chunks):
-        try:
-            embedding_response = client.embeddings.create(
-                model="text-embedding-3-small",
-                input=chunk,
-            )
-        except Exception as exc:
-            raise HTTPException(
-                status_code=502,
-                detail=f"Embedding failed on chunk {idx}: {exc}",
-            ) from exc
+    chunks = [chunk for chunk, _ in chunked]
+    # A dict keeps the first occurrence order while dropping duplicates.
+    chunk_tokens = dict(chunked)
+    unique_chunks = list(chunk_tokens)
+    embedding_map = await find_stored_embeddings(collection, unique_chunks)
+    missing_chunks = [chunk for chunk in unique_chunks if chunk not in embedding_map]
 
-        vector = embedding_response.data[0].embedding
+    try:
+        vectors = (
+            await embed_chunks(missing_chunks, [chunk_tokens[c] for c in missing_chunks])
+            if missing_chunks
+            else []
+        )
+    except Exception as exc:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Embedding failed: {exc}",
+        ) from exc
+
+    for chunk, vector in zip(missing_chunks, vectors):
+        embedding_map[chunk] = to_int8_vector_binary(vector)
 
-        document = {
+    created_at = datetime.now(timezone.utc)
+    documents = [
+        {
             "type": "rag_document",
             "text": chunk,
+            "text_hash": text_hash(chunk),
             "entity": payload.entity,
             "slot": payload.slot,
             "knowledge_type": payload.type,
             "chunk_index": idx,              # ← 중요
-            "embedding": vector,
-            "created_at": datetime.now(timezone.utc),
+            "embedding": embedding_map[chunk],
+            "created_at": created_at,
         }
+        for idx, chunk in enumerate(chunks)
+    ]
 
-        store_rag_document(collection, document)
+    # One bulk write instead of one round-trip per chunk.
+    await store_rag_documents(collection, documents)
 
     return {
         "message": f"Knowledge stored successfully ({len(chunks)} chunks)."
@@ -160,167 +393,270 @@ def store_rag_knowledge(payload: RagStoreRequest) -> dict[str, str]:
 
 
 
-@app.get("/rag/list", response_model=RagListResponse)
-def list_rag_knowledge() -> RagListResponse:
-    """Return recent RAG knowledge documents for the frontend list."""
+# response_model=None turns off FastAPI's response validation for this route;
+# `responses` keeps RagListResponse as the documented schema.
+@app.get(
+    "/rag/list",
+    response_model=None,
+    responses={200: {"model": RagListResponse}},
+)
+async def list_rag_knowledge(
+    request: Request,
+    response: Response,
+) -> dict[str, Any] | Response:
+    """
+    Return recent RAG knowledge documents for the frontend list.
+    Supports ETag / If-None-Match: when nothing changed since the client's
+    last poll we answer 304 without running the list query.
+    """
     collection = get_collection()
-    documents = list_rag_documents(collection, limit=50)
+    etag = f'"{await get_corpus_version(collection)}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    client_tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    if etag in client_tags or "*" in client_tags:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
+    documents = await list_rag_documents(collection, limit=50)
+    # The values come straight from our own DB projection, so we build the
+    # response payload directly in the RagListResponse shape without pydantic
+    # models (no per-document validation on the way in or out).
     formatted = [
-        RagDocumentResponse(
-            id=doc["id"],
-            text=doc["text"],
-            entity=doc.get("entity"),
-            slot=doc.get("slot"),
-            type=doc.get("knowledge_type"),
-            created_at=doc["created_at"].isoformat() if doc["created_at"] else None,
-        )
+        {
+            "id": doc["id"],
+            "text": doc["text"],
+            "entity": doc.get("entity"),
+            "slot": doc.get("slot"),
+            "type": doc.get("knowledge_type"),
+            "created_at": doc["created_at"].isoformat() if doc["created_at"] else None,
+        }
         for doc in documents
     ]
-    return RagListResponse(documents=formatted)
+    return {"documents": formatted}
 
 
 @app.delete("/rag/{document_id}")
-def delete_rag_knowledge(document_id: str) -> dict[str, str]:
+async def delete_rag_knowledge(document_id: str) -> dict[str, str]:
     """Delete a single RAG knowledge document by id."""
     collection = get_collection()
-    deleted = delete_rag_document(collection, document_id)
+    deleted = await delete_rag_document(collection, document_id)
     if not deleted:
         raise HTTPException(status_code=404, detail="Document not found")
     return {"message": "Document deleted."}
 
 
-@app.post("/chat/query", response_model=ChatQueryResponse)
-def chat_query(payload: ChatQueryRequest) -> ChatQueryResponse:
+def _should_skip_rag(question: str, threshold: float) -> bool:
     """
-    RAG-enabled Q&A endpoint.
-    Steps:
-      1) Embed the question.
-      2) Retrieve similar documents from MongoDB Atlas Vector Search.
-      3) Build a context block.
-      4) Ask the LLM to answer with the context.
-      5) Save the chat log for later study.
+    Cheap routing check run before any embedding call.
+    Only explicit greetings / small talk go straight to the LLM, saving one
+    embedding request and one vector search. A threshold of 0.0 means
+    "always use RAG", so nothing is skipped in that case.
     """
-    client = OpenAI()
+    if threshold <= 0.0:
+        return False
+    text = question.strip().rstrip("!?.~ ").lower()
+    return text in SMALL_TALK_MESSAGES
 
-    try:
-        embedding_response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=payload.question,
-        )
-    except Exception as exc:
-        raise HTTPException(status_code=502, detail=f"Embedding failed: {exc}") from exc
-
-    question_vector = embedding_response.data[0].embedding
 
+async def _retrieve(
+    question: str,
+    endpoint: str,
+    threshold: float | None = None,
+) -> tuple[list[float], str, dict[str, Any] | None, list[dict[str, Any]]]:
+    """
+    Shared retrieval step for the chat endpoints.
+    Returns (question vector, corpus version, semantic cache hit or None,
+    retrieved documents).
+    """
     collection = get_collection()
-    retrieved = build_rag_context(collection, question_vector, limit=3)
-    context_text = "\n".join([f"- {doc['text']}" for doc in retrieved])
 
-    system_prompt = (
-        "You are a helpful assistant. Use the provided context when relevant, "
-        "and say when the context does not contain the answer."
+    async def embed() -> list[float]:
+        try:
+            return list(await embed_query(question))
+        except Exception as exc:
+            raise HTTPException(status_code=502, detail=f"Embedding failed: {exc}") from exc
+
+    # The corpus version does not depend on the question, so fetch it while embedding.
+    question_vector, corpus_version = await asyncio.gather(
+        embed(), get_corpus_version(collection)
     )
 
-    user_prompt = (
-        "Context:\n"
-        f"{context_text}\n\n"
-        "Question:\n"
-        f"{payload.question}\n\n"
-        "Answer in Korean to match the learning UI."
+    # The cache probe and the retrieval both only need the question vector,
+    # so run them concurrently instead of paying two sequential round-trips.
+    cached, retrieved = await asyncio.gather(
+        find_cached_answer(
+            get_cache_collection(),
+            question_vector,
+            endpoint=endpoint,
+            corpus_version=corpus_version,
+            threshold=threshold,
+            min_score=CHAT_CACHE_MIN_SCORE,
+        ),
+        build_rag_context(collection, question_vector, limit=3),
     )
+    return question_vector, corpus_version, cached, retrieved
+
+
+async def _answer_llm(question: str, context: list[dict[str, Any]] | None) -> str:
+    """
+    Shared LLM call for the chat endpoints.
+    With context the prompt includes a context block; without it the LLM answers alone.
+    """
+    if context is not None:
+        context_text = "\n".join(f"- {doc['text']}" for doc in context)
+        user_prompt = (
+            f"Context:\n{context_text}\n\n"
+            f"Question:\n{question}{ANSWER_SUFFIX}"
+        )
+    else:
+        user_prompt = f"Question:\n{question}{ANSWER_SUFFIX}"
 
     try:
-        completion = client.chat.completions.create(
+        completion = await openai_client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": user_prompt},
             ],
         )
     except Exception as exc:
         raise HTTPException(status_code=502, detail=f"Chat completion failed: {exc}") from exc
 
-    answer = completion.choices[0].message.content
+    return completion.choices[0].message.content
+
+
+@app.post("/chat/query", response_model=ChatQueryResponse)
+async def chat_query(
+    payload: ChatQueryRequest,
+    background_tasks: BackgroundTasks,
+) -> ChatQueryResponse:
+    """
+    RAG-enabled Q&A endpoint.
+    Steps:
+      1) Embed the question.
+      2) Return a cached answer if a near-identical question was asked before
+         against the same knowledge.
+      3) Retrieve similar documents from MongoDB Atlas Vector Search.
+      4) Ask the LLM to answer with the retrieved context.
+      5) Save the chat log for later study (and the cache entry) after responding.
+    """
+    question_vector, corpus_version, cached, retrieved = await _retrieve(
+        payload.question, endpoint="query"
+    )
+    if cached:
+        retrieved_documents = cached.get("retrieved_documents", [])
+        background_tasks.add_task(
+            log_chat,
+            collection=get_collection(),
+            question=payload.question,
+            answer=cached["answer"],
+            retrieved_documents=retrieved_documents,
+            cache_hit=True,
+        )
+        return ChatQueryResponse(
+            answer=cached["answer"],
+            retrieved_documents=retrieved_documents,
+        )
+
+    answer = await _answer_llm(payload.question, retrieved)
 
-    log_chat(
-        collection=collection,
+    background_tasks.add_task(
+        log_chat,
+        collection=get_collection(),
         question=payload.question,
         answer=answer,
         retrieved_documents=retrieved,
     )
+    background_tasks.add_task(
+        store_cached_answer,
+        cache_collection=get_cache_collection(),
+        question_vector=question_vector,
+        endpoint="query",
+        corpus_version=corpus_version,
+        answer=answer,
+        retrieved_documents=retrieved,
+    )
 
     return ChatQueryResponse(answer=answer, retrieved_documents=retrieved)
 
 
 @app.post("/chat/route", response_model=ChatRouteResponse)
-def chat_route(payload: ChatRouteRequest) -> ChatRouteResponse:
+async def chat_route(
+    payload: ChatRouteRequest,
+    background_tasks: BackgroundTasks,
+) -> ChatRouteResponse:
     """
     Simple query routing endpoint.
-    If the top retrieved score is below the threshold, fall back to a plain LLM answer.
-    Otherwise use RAG context.
+    Greetings / small talk are sent straight to the LLM without embedding or
+    retrieval (unless threshold=0.0 forces RAG).
+    Otherwise, if the top retrieved score is below the threshold, fall back to a
+    plain LLM answer; if it is above, use RAG context.
+    Near-identical questions (same knowledge, same threshold) are answered
+    from the semantic cache.
+    The chat log is written in the background after the response is sent.
     """
-    client = OpenAI()
-
-    try:
-        embedding_response = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=payload.question,
+    if _should_skip_rag(payload.question, payload.threshold):
+        answer = await _answer_llm(payload.question, None)
+        background_tasks.add_task(
+            log_chat,
+            collection=get_collection(),
+            question=payload.question,
+            answer=answer,
+            retrieved_documents=[],
+            route="llm",
         )
-    except Exception as exc:
-        raise HTTPException(status_code=502, detail=f"Embedding failed: {exc}") from exc
-
-    question_vector = embedding_response.data[0].embedding
-    collection = get_collection()
-    retrieved = build_rag_context(collection, question_vector, limit=3)
+        return ChatRouteResponse(answer=answer, retrieved_documents=[], route="llm")
 
-    top_score = retrieved[0]["score"] if retrieved else 0.0
-    use_rag = top_score >= payload.threshold
-    route = "rag" if use_rag else "llm"
-
-    system_prompt = (
-        "You are a helpful assistant. Use the provided context when relevant, "
-        "and say when the context does not contain the answer."
+    question_vector, corpus_version, cached, retrieved = await _retrieve(
+        payload.question, endpoint="route", threshold=payload.threshold
     )
-
-    if use_rag:
-        context_text = "\n".join([f"- {doc['text']}" for doc in retrieved])
-        user_prompt = (
-            "Context:\n"
-            f"{context_text}\n\n"
-            "Question:\n"
-            f"{payload.question}\n\n"
-            "Answer in Korean to match the learning UI."
+    if cached:
+        retrieved_documents = cached.get("retrieved_documents", [])
+        route = cached.get("route", "llm")
+        background_tasks.add_task(
+            log_chat,
+            collection=get_collection(),
+            question=payload.question,
+            answer=cached["answer"],
+            retrieved_documents=retrieved_documents,
+            route=route,
+            cache_hit=True,
         )
-    else:
-        user_prompt = (
-            "Question:\n"
-            f"{payload.question}\n\n"
-            "Answer in Korean to match the learning UI."
+        return ChatRouteResponse(
+            answer=cached["answer"],
+            retrieved_documents=retrieved_documents,
+            route=route,
         )
 
-    try:
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-        )
-    except Exception as exc:
-        raise HTTPException(status_code=502, detail=f"Chat completion failed: {exc}") from exc
+    top_score = retrieved[0]["score"] if retrieved else 0.0
+    use_rag = top_score >= payload.threshold
+    route = "rag" if use_rag else "llm"
+    used_documents = retrieved if use_rag else []
 
-    answer = completion.choices[0].message.content
+    answer = await _answer_llm(payload.question, retrieved if use_rag else None)
 
-    log_chat(
-        collection=collection,
+    background_tasks.add_task(
+        log_chat,
+        collection=get_collection(),
         question=payload.question,
         answer=answer,
-        retrieved_documents=retrieved if use_rag else [],
+        retrieved_documents=used_documents,
+        route=route,
+    )
+    background_tasks.add_task(
+        store_cached_answer,
+        cache_collection=get_cache_collection(),
+        question_vector=question_vector,
+        endpoint="route",
+        corpus_version=corpus_version,
+        answer=answer,
+        retrieved_documents=used_documents,
         route=route,
+        threshold=payload.threshold,
     )
 
     return ChatRouteResponse(
         answer=answer,
-        retrieved_documents=retrieved if use_rag else [],
+        retrieved_documents=used_documents,
         route=route,
     )
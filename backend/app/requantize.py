@@ -0,0 +1,73 @@
+"""
+One-off migration: re-quantize stored RAG embeddings to int8 binData.
+
+Documents stored before the int8 switch hold `embedding` as a float array
+(or float32 binData). Queries are now int8, so those documents no longer
+match the vector index. This rewrites them in place, without calling the
+embedding API again, and backfills `text_hash` where it is missing.
+
+Run once from backend/app:  python requantize.py
+"""
+import asyncio
+
+from bson.binary import VECTOR_SUBTYPE, Binary, BinaryVectorDtype
+from pymongo import UpdateOne
+
+from db import close_mongo, get_collection, text_hash, to_int8_vector_binary
+
+
+BATCH_SIZE = 500
+
+
+def needs_requantize(embedding: object) -> bool:
+    """True for float arrays and float32 binData; int8 vectors are left alone."""
+    if isinstance(embedding, list):
+        return True
+    return (
+        isinstance(embedding, Binary)
+        and embedding.subtype == VECTOR_SUBTYPE
+        and embedding[:1] == BinaryVectorDtype.FLOAT32.value
+    )
+
+
+async def requantize() -> int:
+    collection = get_collection()
+    cursor = collection.find(
+        {"type": "rag_document"},
+        {"_id": 1, "text": 1, "text_hash": 1, "embedding": 1},
+    )
+
+    updated = 0
+    ops: list[UpdateOne] = []
+    async for doc in cursor:
+        embedding = doc.get("embedding")
+        if not needs_requantize(embedding):
+            continue
+
+        vector = embedding if isinstance(embedding, list) else embedding.as_vector().data
+        fields = {"embedding": to_int8_vector_binary(vector)}
+        if "text_hash" not in doc:
+            fields["text_hash"] = text_hash(doc.get("text", ""))
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+
+        if len(ops) >= BATCH_SIZE:
+            await collection.bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+
+    if ops:
+        await collection.bulk_write(ops, ordered=False)
+        updated += len(ops)
+    return updated
+
+
+async def main() -> None:
+    try:
+        updated = await requantize()
+        print(f"re-quantized {updated} documents")
+    finally:
+        close_mongo()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())